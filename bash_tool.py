@@ -4,219 +4,604 @@ Bash Command Tool – LLM can execute shell commands
 """
 
 import argparse
+import asyncio
+import functools
 import json
+import logging
 import os
-import subprocess
+import re
 import sys
-from typing import Dict, Any, Callable, Tuple, Optional
-from anthropic import Anthropic
+import threading
+from collections import OrderedDict, deque
+from typing import Dict, Any, Awaitable, Callable, Tuple, Optional, Union
+import httpx
+from anthropic import AsyncAnthropic
 from dataclasses import dataclass
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:
+    # orjson is optional; fall back to the standard library json module
+    orjson = None
+
 load_dotenv()
 BASE_URL = os.getenv("BASE_URL")
 API_KEY = os.getenv("API_KEY")
 MODEL_NAME = os.getenv("MODEL_NAME", "glm-4.7")
-
-@dataclass
+# Optional cheaper model for short conversational turns; routing is off when unset
+SIMPLE_MODEL_NAME = os.getenv("SIMPLE_MODEL_NAME")
+logger = logging.getLogger("agent")
+# ANSI colors are disabled when stdout is not a terminal or NO_COLOR is set
+USE_COLOR = sys.stdout.isatty() and not os.getenv("NO_COLOR")
+USER_PROMPT = "\033[94mYou\033[0m: " if USE_COLOR else "You: "
+MODEL_PROMPT = "\033[93mLLM\033[0m: " if USE_COLOR else "LLM: "
+TOOL_PROMPT = "\033[96mtool\033[0m: " if USE_COLOR else "tool: "
+RESULT_PROMPT = "\033[92mresult\033[0m: " if USE_COLOR else "result: "
+ERROR_PROMPT = "\033[91merror\033[0m: " if USE_COLOR else "error: "
+# Directories that list_files never descends into
+LIST_FILES_IGNORED_DIRS = frozenset({".devenv", ".git", "__pycache__", "node_modules"})
+# Maximum number of cached read-only tool results
+TOOL_CACHE_SIZE = 256
+# ...and their maximum total size in characters (a read_file result alone can be 256KB)
+TOOL_CACHE_MAX_CHARS = 16 * 1024 * 1024
+# Number of recent turns (user + assistant exchanges) kept verbatim when older history is summarized
+HISTORY_WINDOW_TURNS = 8
+# Summarize older history once the stored conversation grows past this many messages
+HISTORY_SUMMARY_THRESHOLD = 40
+# ...or once its estimated size passes this many tokens
+HISTORY_TOKEN_BUDGET = 20000
+# Abort a streamed response if no chunk arrives within this many seconds
+STREAM_IDLE_TIMEOUT = 30
+# Messages routed to SIMPLE_MODEL_NAME are shorter than this and mention no files, code or commands
+SIMPLE_TURN_MAX_CHARS = 120
+SIMPLE_TURN_EXCLUDE = re.compile(r"```|[/\\]|\.\w{1,4}\b|\b(read|edit|write|run|bash|list|search|find|file|code|fix)", re.IGNORECASE)
+# Tools without side effects; only these run concurrently, every other tool runs alone and
+# in request order
+READ_ONLY_TOOLS = frozenset({"read_file", "list_files", "code_search"})
+# Maximum number of tool calls from one turn that run at the same time
+TOOL_CONCURRENCY_LIMIT = int(os.environ.get("TOOL_CONCURRENCY_LIMIT", 8))
+# Tool inputs echoed to the terminal and logs are cut off after this many characters
+TOOL_INPUT_PREVIEW_CHARS = 500
+# Tool output beyond this size keeps only its head and tail
+MAX_OUTPUT_BYTES = 256 * 1024
+# A bash command is killed once it has written this much output
+BASH_KILL_OUTPUT_BYTES = 16 * 1024 * 1024
+
+@dataclass(slots=True, frozen=True)
 class ToolDefinition:
     name: str
     description: str
     input_schema: Dict[str, Any]
-    function: Callable[[Dict[str, Any]], Tuple[str, Optional[Exception]]]
+    # Tools may be plain functions or coroutine functions (e.g. subprocess based tools)
+    function: Callable[[Dict[str, Any]], Union[Tuple[str, Optional[Exception]], Awaitable[Tuple[str, Optional[Exception]]]]]
 
 
 class Agent:
-    def __init__(self, client: Anthropic, tools: list[ToolDefinition], verbose: bool = False):
+    def __init__(self, client: AsyncAnthropic, tools: list[ToolDefinition], verbose: bool = False):
         self.client = client
         self.tools = tools
         self.verbose = verbose
-
-    def run(self):
+        self.tool_map = {tool.name: tool for tool in tools}
+        self.tool_slots = None
+        self.side_effect_lock = None
+        # Tool schemas never change during a session, so build the API payload once
+        self.anthropic_tools = [
+            {
+                "name": tool.name,
+                "description": tool.description,
+                "input_schema": tool.input_schema
+            }
+            for tool in tools
+        ]
+        # A cache breakpoint on the last tool caches the whole tools block server-side
+        if self.anthropic_tools:
+            self.anthropic_tools[-1]["cache_control"] = {"type": "ephemeral"}
+
+    async def run(self):
         conversation = []
 
-        if self.verbose:
-            print("Starting chat session with tools enabled", file=sys.stderr)
+        logger.debug("Starting chat session with tools enabled")
 
-        print("Chat with LLM (use 'ctrl-c' to quit)")
+        sys.stdout.write("Chat with LLM (use 'ctrl-c' to quit)\n")
 
         while True:
             try:
-                print("\033[94mYou\033[0m: ", end="", flush=True)
-                user_input = input()
+                sys.stdout.write(USER_PROMPT)
+                sys.stdout.flush()
+                user_input = await read_input()
             except (EOFError, KeyboardInterrupt):
-                if self.verbose:
-                    print("User input ended, breaking from chat loop", file=sys.stderr)
+                logger.debug("User input ended, breaking from chat loop")
                 break
 
             # Skip empty messages
             if not user_input.strip():
-                if self.verbose:
-                    print("Skipping empty message", file=sys.stderr)
+                logger.debug("Skipping empty message")
                 continue
 
-            if self.verbose:
-                print(f'User input received: "{user_input}"', file=sys.stderr)
+            if not await self.run_turn(conversation, user_input):
+                return
+
+        logger.debug("Chat session ended")
+
+    async def run_turn(self, conversation, user_input):
+        # Caps how many read-only tool calls run at the same time, and keeps side-effecting
+        # ones from ever overlapping; created on first use so they belong to the running loop
+        if self.tool_slots is None:
+            self.tool_slots = asyncio.Semaphore(TOOL_CONCURRENCY_LIMIT)
+            self.side_effect_lock = asyncio.Lock()
+
+        logger.debug('User input received: "%s"', user_input)
+
+        # Files may have changed outside the agent since the last turn; only read_file
+        # entries, which are keyed on file stat, stay valid
+        clear_tool_cache()
+
+        # Compact only on a turn boundary, never in the middle of a tool loop
+        if len(conversation) > HISTORY_SUMMARY_THRESHOLD or estimate_tokens(conversation) > HISTORY_TOKEN_BUDGET:
+            await self.summarize_history(conversation)
+
+        conversation.append({
+            "role": "user",
+            "content": user_input
+        })
+
+        logger.debug("Sending message to LLM, conversation length: %s", len(conversation))
+
+        message = await self.run_inference(conversation)
+        if message is None:
+            return False
+
+        conversation.append({
+            "role": "assistant",
+            "content": message["content"]
+        })
+
+        # Keep processing until LLM stops using tools
+        while True:
+            logger.debug("Processing %s content blocks from LLM", len(message['content']))
+
+            # Text blocks were already streamed to the terminal by run_inference
+            tool_uses = [block for block in message["content"] if block.type == "tool_use"]
+
+            # If there were no tool uses, we're done
+            if not tool_uses:
+                return True
+
+            # Read-only tools run concurrently (some were already started by run_inference);
+            # a side-effecting tool waits for everything before it and holds back everything
+            # after it, so edits and commands apply in the order the model asked for them
+            tool_tasks = message["tool_tasks"]
+            tool_results = []
+            pending = []
+            for tool_use in tool_uses:
+                if tool_use.name in READ_ONLY_TOOLS:
+                    pending.append(tool_tasks.get(tool_use.id) or self.execute_tool(tool_use))
+                    continue
+                tool_results.extend(await asyncio.gather(*pending))
+                pending = []
+                tool_results.append(await (tool_tasks.get(tool_use.id) or self.execute_tool(tool_use)))
+            tool_results.extend(await asyncio.gather(*pending))
+
+            sys.stdout.write("".join(
+                f"{ERROR_PROMPT if result['is_error'] else RESULT_PROMPT}{result['content']}\n"
+                for result in tool_results
+            ))
+
+            # Send all tool results back and get LLM's response
+            logger.debug("Sending %s tool results back to LLM", len(tool_results))
 
             conversation.append({
                 "role": "user",
-                "content": user_input
+                "content": tool_results
             })
 
-            if self.verbose:
-                print(f"Sending message to LLM, conversation length: {len(conversation)}", file=sys.stderr)
-
-            message = self.run_inference(conversation)
+            # Get LLM's response after tool execution
+            message = await self.run_inference(conversation)
             if message is None:
-                return
+                return False
 
             conversation.append({
                 "role": "assistant",
                 "content": message["content"]
             })
 
-            # Keep processing until LLM stops using tools
-            while True:
-                tool_results = []
-                has_tool_use = False
-
-                if self.verbose:
-                    print(f"Processing {len(message['content'])} content blocks from LLM", file=sys.stderr)
-
-                for content in message["content"]:
-                    if content["type"] == "text":
-                        print(f"\033[93mLLM\033[0m: {content['text']}")
-                    elif content["type"] == "tool_use":
-                        has_tool_use = True
-                        tool_use = content
-                        tool_name = tool_use["name"]
-                        tool_input = tool_use["input"]
-
-                        if self.verbose:
-                            print(f"Tool use detected: {tool_name} with input: {json.dumps(tool_input)}", file=sys.stderr)
-
-                        print(f"\033[96mtool\033[0m: {tool_name}({json.dumps(tool_input)})")
-
-                        # Find and execute the tool
-                        tool_result = None
-                        tool_error = None
-                        tool_found = False
-
-                        for tool in self.tools:
-                            if tool.name == tool_name:
-                                if self.verbose:
-                                    print(f"Executing tool: {tool.name}", file=sys.stderr)
-
-                                try:
-                                    tool_result, tool_error = tool.function(tool_input)
-                                    print(f"\033[92mresult\033[0m: {tool_result}")
-                                    if tool_error:
-                                        print(f"\033[91merror\033[0m: {tool_error}", file=sys.stderr)
-                                except Exception as e:
-                                    tool_error = str(e)
-                                    print(f"\033[91merror\033[0m: {tool_error}")
-
-                                if self.verbose:
-                                    if tool_error:
-                                        print(f"Tool execution failed: {tool_error}", file=sys.stderr)
-                                    else:
-                                        print(f"Tool execution successful, result length: {len(tool_result)} chars", file=sys.stderr)
-
-                                tool_found = True
-                                break
-
-                        if not tool_found:
-                            tool_error = f"tool '{tool_name}' not found"
-                            print(f"\033[91merror\033[0m: {tool_error}")
-
-                        # Add tool result to collection
-                        if tool_error:
-                            tool_results.append({
-                                "type": "tool_result",
-                                "tool_use_id": tool_use["id"],
-                                "content": tool_error,
-                                "is_error": True
-                            })
-                        else:
-                            tool_results.append({
-                                "type": "tool_result",
-                                "tool_use_id": tool_use["id"],
-                                "content": tool_result,
-                                "is_error": False
-                            })
-
-                # If there were no tool uses, we're done
-                if not has_tool_use:
-                    break
-
-                # Send all tool results back and get LLM's response
-                if self.verbose:
-                    print(f"Sending {len(tool_results)} tool results back to LLM", file=sys.stderr)
-
-                conversation.append({
-                    "role": "user",
-                    "content": tool_results
-                })
+            logger.debug("Received followup response with %s content blocks", len(message['content']))
+
+    async def execute_tool(self, tool_use):
+        tool_name = tool_use.name
+        tool_input = tool_use.input
 
-                # Get LLM's response after tool execution
-                message = self.run_inference(conversation)
-                if message is None:
-                    return
+        # Find and execute the tool
+        tool_result = None
+        tool_error = None
 
-                conversation.append({
-                    "role": "assistant",
-                    "content": message["content"]
-                })
+        tool = self.tool_map.get(tool_name)
+        if tool is None:
+            tool_error = f"tool '{tool_name}' not found"
+        else:
+            logger.debug("Executing tool: %s", tool.name)
 
-                if self.verbose:
-                    print(f"Received followup response with {len(message['content'])} content blocks", file=sys.stderr)
+            try:
+                # A cache hit is answered inline, since a thread hop would cost more than the
+                # lookup; misses do the real work off the event loop
+                cached_result = getattr(tool.function, "cached_result", None)
+                result = cached_result(tool_input) if cached_result is not None else None
+                if result is not None:
+                    tool_result, tool_error = result
+                else:
+                    # Read-only tools share the concurrency slots; bash and edit_file change the
+                    # files the others read (and clear the tool cache), so they run alone
+                    guard = self.tool_slots if tool.name in READ_ONLY_TOOLS else self.side_effect_lock
+                    async with guard:
+                        if asyncio.iscoroutinefunction(tool.function):
+                            tool_result, tool_error = await tool.function(tool_input)
+                        else:
+                            # Blocking tools run in a worker thread so they can overlap with each other
+                            tool_result, tool_error = await asyncio.to_thread(tool.function, tool_input)
+            except Exception as e:
+                tool_error = str(e)
+
+            if tool_error:
+                logger.debug("Tool execution failed: %s", tool_error)
+            else:
+                logger.debug("Tool execution successful, result length: %s chars", len(tool_result))
+
+        if tool_error:
+            return {
+                "type": "tool_result",
+                "tool_use_id": tool_use.id,
+                "content": str(tool_error),
+                "is_error": True
+            }
+        return {
+            "type": "tool_result",
+            "tool_use_id": tool_use.id,
+            "content": tool_result,
+            "is_error": False
+        }
 
-        if self.verbose:
-            print("Chat session ended", file=sys.stderr)
+    def with_cache_breakpoint(self, conversation):
+        # The newest message gets a breakpoint so this request's whole prefix is written to
+        # the cache; the third-from-last one is where the previous request wrote it, so it
+        # is read back instead of being processed again. Together with the tools breakpoint
+        # this stays within the API limit of four breakpoints per request
+        messages = list(conversation)
+        for index in (-3, -1):
+            if len(messages) < -index:
+                continue
 
-    def run_inference(self, conversation):
-        anthropic_tools = []
-        for tool in self.tools:
-            anthropic_tools.append({
-                "name": tool.name,
-                "description": tool.description,
-                "input_schema": tool.input_schema
-            })
+            message = messages[index]
+            content = message["content"]
+            if isinstance(content, str):
+                content = [{"type": "text", "text": content}]
+            if not content:
+                continue
 
-        if self.verbose:
-            print(f"Making API call to LLM with model: {MODEL_NAME} and {len(anthropic_tools)} tools", file=sys.stderr)
+            # Copy the marked block so the stored conversation itself is never modified
+            last_block = content[-1]
+            if not isinstance(last_block, dict):
+                # Assistant messages hold the SDK's content block models
+                last_block = last_block.model_dump(exclude_none=True)
+            marked_block = {**last_block, "cache_control": {"type": "ephemeral"}}
+            messages[index] = {**message, "content": [*content[:-1], marked_block]}
+        return messages
+
+    async def summarize_history(self, conversation):
+        # Replace everything before the most recent turns with a short summary exchange
+        cut = next_user_turn(conversation, max(1, len(conversation) - HISTORY_WINDOW_TURNS * 2))
+        if estimate_tokens(conversation[cut:]) > HISTORY_TOKEN_BUDGET:
+            # The recent turns alone are over budget: keep only the latest one verbatim
+            cut = previous_user_turn(conversation, len(conversation) - 1)
+        if cut >= len(conversation) or cut <= 2:
+            return
+
+        logger.debug("Summarizing %s earlier messages", cut)
 
         try:
-            message = self.client.messages.create(
-                model=MODEL_NAME,   
+            message = await self.client.messages.create(
+                model=MODEL_NAME,
                 max_tokens=1024,
-                messages=conversation,
-                tools=anthropic_tools
+                messages=conversation[:cut] + [{
+                    "role": "user",
+                    "content": "Summarize our conversation so far, keeping file paths, decisions and open tasks."
+                }],
+                tools=self.anthropic_tools
+            )
+        except Exception as e:
+            logger.debug("Summarization failed, keeping full history: %s", e)
+            return
+
+        summary = "".join(block.text for block in message.content if block.type == "text")
+        conversation[:cut] = [
+            {"role": "user", "content": "Summarize our conversation so far."},
+            {"role": "assistant", "content": [{"type": "text", "text": f"Summary so far: {summary}"}]}
+        ]
+
+    def pick_model(self, conversation):
+        # Short chit-chat goes to the cheaper model; tool follow-ups and anything that looks
+        # like real work stay on MODEL_NAME
+        content = conversation[-1]["content"]
+        if (
+            SIMPLE_MODEL_NAME
+            and isinstance(content, str)
+            and len(content) < SIMPLE_TURN_MAX_CHARS
+            and not SIMPLE_TURN_EXCLUDE.search(content)
+        ):
+            return SIMPLE_MODEL_NAME
+        return MODEL_NAME
+
+    async def run_inference(self, conversation):
+        model = self.pick_model(conversation)
+        logger.debug("Making API call to LLM with model: %s and %s tools", model, len(self.anthropic_tools))
+
+        tool_tasks = {}
+        early_start = True
+        try:
+            # Stream text to the terminal as it arrives instead of waiting for the full reply
+            line_open = False
+            async with self.client.messages.stream(
+                model=model,
+                max_tokens=1024,
+                messages=self.with_cache_breakpoint(conversation),
+                tools=self.anthropic_tools,
+                extra_headers={"anthropic-beta": "prompt-caching-2024-07-31"}
+            ) as stream:
+                events = stream.__aiter__()
+                while True:
+                    try:
+                        event = await asyncio.wait_for(events.__anext__(), STREAM_IDLE_TIMEOUT)
+                    except StopAsyncIteration:
+                        break
+                    except asyncio.TimeoutError:
+                        raise TimeoutError(f"No response chunk received for {STREAM_IDLE_TIMEOUT} seconds")
+
+                    if event.type == "text":
+                        if not line_open:
+                            sys.stdout.write(MODEL_PROMPT)
+                            line_open = True
+                        sys.stdout.write(event.text)
+                        sys.stdout.flush()
+                    elif event.type == "content_block_stop" and event.content_block.type == "tool_use":
+                        # Start read-only tools as soon as their call is complete, so they run
+                        # while the rest of the response is still streaming. Side-effecting
+                        # tools wait for the full response (run_turn runs them), and so does
+                        # every tool listed after one
+                        block = event.content_block
+                        tool_input = _LazyJSON(block.input)
+                        logger.debug("Tool use detected: %s with input: %s", block.name, tool_input)
+                        if line_open:
+                            sys.stdout.write("\n")
+                            line_open = False
+                        sys.stdout.write(f"{TOOL_PROMPT}{block.name}({tool_input})\n")
+                        sys.stdout.flush()
+                        early_start = early_start and block.name in READ_ONLY_TOOLS
+                        if early_start:
+                            tool_tasks[block.id] = asyncio.create_task(self.execute_tool(block))
+
+                message = await stream.get_final_message()
+
+            if line_open:
+                sys.stdout.write("\n")
+                sys.stdout.flush()
+
+            logger.debug("API call successful, response received")
+            # Cache counters show whether the breakpoints are actually being hit; older SDKs
+            # and some backends leave them out
+            usage = message.usage
+            logger.debug(
+                "Token usage: input=%s, output=%s, cache_creation=%s, cache_read=%s",
+                usage.input_tokens,
+                usage.output_tokens,
+                getattr(usage, "cache_creation_input_tokens", None),
+                getattr(usage, "cache_read_input_tokens", None)
             )
 
-            if self.verbose:
-                print("API call successful, response received", file=sys.stderr)
-
-            content = []
-            for block in message.content:
-                if block.type == "text":
-                    content.append({"type": "text", "text": block.text})
-                elif block.type == "tool_use":
-                    content.append({
-                        "type": "tool_use",
-                        "id": block.id,
-                        "name": block.name,
-                        "input": block.input
-                    })
-
-            return {"content": content}
+            # The SDK's own content blocks are sent back as they are, no dict copies needed.
+            # Only text and tool_use blocks are kept: SDKs without a thinking block model parse
+            # thinking blocks as TextBlock, which would then be sent back malformed
+            content = [block for block in message.content if block.type in ("text", "tool_use")]
+            return {"content": content, "tool_tasks": tool_tasks}
         except Exception as e:
-            if self.verbose:
-                print(f"API call failed: {e}", file=sys.stderr)
-            print(f"Error: {e}")
+            # Tools started from a failed response are abandoned
+            for task in tool_tasks.values():
+                task.cancel()
+            logger.debug("API call failed: %s", e)
+            sys.stdout.write(f"Error: {e}\n")
             return None
 
 
+def is_user_turn(message) -> bool:
+    """判断消息是否为用户发起的新一轮对话（而不是工具结果）"""
+    if message["role"] != "user":
+        return False
+    content = message["content"]
+    return isinstance(content, str) or not any(block.get("type") == "tool_result" for block in content)
+
+
+def next_user_turn(conversation, start: int) -> int:
+    """返回 start 及之后第一条用户轮次消息的下标，不存在时返回 len(conversation)"""
+    for i in range(start, len(conversation)):
+        if is_user_turn(conversation[i]):
+            return i
+    return len(conversation)
+
+
+def previous_user_turn(conversation, start: int) -> int:
+    """返回 start 及之前最后一条用户轮次消息的下标"""
+    for i in range(start, -1, -1):
+        if is_user_turn(conversation[i]):
+            return i
+    return 0
+
+
+def estimate_tokens(conversation) -> int:
+    """粗略估算对话的 token 数，按约 4 个字符一个 token 计算"""
+    chars = 0
+    for message in conversation:
+        content = message["content"]
+        if isinstance(content, str):
+            chars += len(content)
+            continue
+        for block in content:
+            if not isinstance(block, dict):
+                block = block.model_dump(exclude_none=True)
+            chars += len(json_dumps(block))
+    return chars // 4
+
+
+def json_dumps(obj, sort_keys: bool = False) -> str:
+    """序列化为 JSON 字符串，安装了 orjson 时使用更快的 orjson"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0).decode()
+    return json.dumps(obj, ensure_ascii=False, sort_keys=sort_keys)
+
+
+class _LazyJSON:
+    """在真正输出时才序列化为 JSON，过长的内容只保留开头"""
+
+    def __init__(self, obj):
+        self.obj = obj
+        self.text = None
+
+    def __str__(self):
+        if self.text is None:
+            text = json_dumps(self.obj)
+            if len(text) > TOOL_INPUT_PREVIEW_CHARS:
+                text = f"{text[:TOOL_INPUT_PREVIEW_CHARS]}...[+{len(text) - TOOL_INPUT_PREVIEW_CHARS} chars]"
+            self.text = text
+        return self.text
+
+
+async def read_input() -> str:
+    """在后台线程中读取一行用户输入，避免阻塞事件循环"""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(line, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(line)
+
+    def reader():
+        try:
+            line, error = input(), None
+        except Exception as e:
+            line, error = "", e
+        try:
+            loop.call_soon_threadsafe(resolve, line, error)
+        except RuntimeError:
+            # The event loop has already been closed (e.g. after ctrl-c)
+            pass
+
+    # A daemon thread never keeps the interpreter alive, so ctrl-c exits immediately
+    threading.Thread(target=reader, daemon=True).start()
+    return await future
+
+
+# 只读工具的结果缓存（LRU）；每轮对话开始时以及执行有副作用的工具（bash、edit_file）后清空
+_tool_cache: "OrderedDict[Tuple[str, Any], Tuple[str, Optional[Exception]]]" = OrderedDict()
+_tool_cache_lock = threading.Lock()
+# 缓存中所有结果的总字符数
+_tool_cache_chars = 0
+# 缓存键包含文件状态（mtime、大小）的工具，文件变化时条目自动失效，清空缓存时无需丢弃
+_stat_keyed_tools = set()
+
+
+def clear_tool_cache():
+    """清空只读工具的结果缓存，保留以文件状态为键的条目"""
+    global _tool_cache_chars
+    with _tool_cache_lock:
+        for cache_key in [k for k in _tool_cache if k[0] not in _stat_keyed_tools]:
+            _tool_cache_chars -= len(_tool_cache.pop(cache_key)[0])
+
+
+def cached_tool(key: Optional[Callable[[Dict[str, Any]], Any]] = None, stat_keyed: bool = False):
+    """缓存只读工具的结果，默认以输入参数的稳定 JSON 序列化作为缓存键"""
+    def decorator(function):
+        if stat_keyed:
+            _stat_keyed_tools.add(function.__name__)
+
+        def make_key(input_data):
+            if key is None:
+                return function.__name__, json_dumps(input_data, sort_keys=True)
+            tool_key = key(input_data)
+            return None if tool_key is None else (function.__name__, tool_key)
+
+        def lookup(cache_key):
+            if cache_key is None:
+                return None
+            with _tool_cache_lock:
+                result = _tool_cache.get(cache_key)
+                if result is not None:
+                    _tool_cache.move_to_end(cache_key)
+                return result
+
+        def remember(cache_key, result):
+            global _tool_cache_chars
+            # 只缓存成功的结果，出错时下次重新执行；按条目数和总字符数淘汰最久未用的条目
+            if cache_key is not None and result[1] is None and len(result[0]) <= TOOL_CACHE_MAX_CHARS:
+                with _tool_cache_lock:
+                    previous = _tool_cache.pop(cache_key, None)
+                    if previous is not None:
+                        _tool_cache_chars -= len(previous[0])
+                    _tool_cache[cache_key] = result
+                    _tool_cache_chars += len(result[0])
+                    while len(_tool_cache) > TOOL_CACHE_SIZE or _tool_cache_chars > TOOL_CACHE_MAX_CHARS:
+                        _tool_cache_chars -= len(_tool_cache.popitem(last=False)[1][0])
+            return result
+
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(input_data):
+                cache_key = make_key(input_data)
+                result = lookup(cache_key)
+                if result is not None:
+                    return result
+                return remember(cache_key, await function(input_data))
+        else:
+            @functools.wraps(function)
+            def wrapper(input_data):
+                cache_key = make_key(input_data)
+                result = lookup(cache_key)
+                if result is not None:
+                    return result
+                return remember(cache_key, function(input_data))
+
+        # 仅查缓存、不执行工具，未命中时返回 None
+        wrapper.cached_result = lambda input_data: lookup(make_key(input_data))
+        return wrapper
+    return decorator
+
+
+def truncate_output(head: bytes, tail: bytes, total_size: int) -> str:
+    """拼接输出的头部和尾部，中间用标记注明省略的字节数"""
+    skipped = total_size - len(head) - len(tail)
+    if skipped <= 0:
+        return (head + tail).decode("utf-8", errors="replace")
+    return (
+        head.decode("utf-8", errors="replace")
+        + f"\n...[truncated {skipped} bytes]...\n"
+        + tail.decode("utf-8", errors="replace")
+    )
+
+
+def _read_file_cache_key(input_data: Dict[str, Any]):
+    """以 (绝对路径, mtime, 大小) 作为 read_file 的缓存键，文件被修改后缓存自动失效"""
+    path = input_data.get("path")
+    if not path:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return os.path.abspath(path), st.st_mtime_ns, st.st_size
+
+
+@cached_tool(key=_read_file_cache_key, stat_keyed=True)
 def read_file(input_data: Dict[str, Any]) -> Tuple[str, Optional[Exception]]:
     """读取文件内容"""
     try:
@@ -225,69 +610,175 @@ def read_file(input_data: Dict[str, Any]) -> Tuple[str, Optional[Exception]]:
             return "", ValueError("path is required")
 
         with open(path, "r", encoding="utf-8") as f:
-            content = f.read()
+            size = os.fstat(f.fileno()).st_size
+            if size <= MAX_OUTPUT_BYTES:
+                content = f.read()
+            else:
+                # 大文件只读取开头和结尾，避免整个文件进入内存和后续请求
+                half = MAX_OUTPUT_BYTES // 2
+                head = f.buffer.read(half)
+                f.buffer.seek(-half, os.SEEK_END)
+                content = truncate_output(head, f.buffer.read(), size)
 
         return content, None
     except Exception as e:
         return "", e
 
 
-def list_files(input_data: Dict[str, Any]) -> Tuple[str, Optional[Exception]]:
+@cached_tool()
+async def list_files(input_data: Dict[str, Any]) -> Tuple[str, Optional[Exception]]:
     """列出目录中的文件和文件夹"""
     try:
         dir_path = input_data.get("path", ".")
         if not dir_path:
             dir_path = "."
 
-        files = []
-        for root, dirs, filenames in os.walk(dir_path):
-            # Skip .devenv directory
-            if ".devenv" in dirs:
-                dirs.remove(".devenv")
-
-            rel_root = os.path.relpath(root, dir_path)
-            if rel_root == ".":
-                rel_root = ""
-
-            for d in dirs:
-                rel_path = os.path.join(rel_root, d) if rel_root else d
-                files.append(rel_path + "/")
-
-            for f in filenames:
-                rel_path = os.path.join(rel_root, f) if rel_root else f
-                files.append(rel_path)
+        try:
+            files = await _list_files_rg(dir_path)
+        except FileNotFoundError:
+            # 未安装 ripgrep（或目录不存在）时退回到 Python 遍历
+            files = await asyncio.to_thread(_list_files_walk, dir_path)
 
-        result = json.dumps(files, ensure_ascii=False)
+        result = json_dumps(files)
         return result, None
     except Exception as e:
         return "", e
 
 
-def bash(input_data: Dict[str, Any]) -> Tuple[str, Optional[Exception]]:
+async def _list_files_rg(dir_path: str) -> list[str]:
+    """用 ripgrep 的并行遍历器列出文件（遵循 .gitignore），并补全文件所在的目录"""
+    args = ["rg", "--files", "--hidden"]
+    for name in sorted(LIST_FILES_IGNORED_DIRS):
+        args.extend(["--glob", f"!{name}"])
+
+    # 在目标目录下执行，输出即为相对路径
+    proc = await asyncio.create_subprocess_exec(
+        *args,
+        cwd=dir_path,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=30)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise TimeoutError("Listing files timed out after 30 seconds")
+
+    # ripgrep 返回退出码 1 表示没有文件，这不是错误
+    if proc.returncode not in (0, 1) and not stdout:
+        raise ValueError(f"listing files failed: {stderr.decode('utf-8', errors='replace')}")
+
+    files = []
+    seen_dirs = set()
+    for path in stdout.decode("utf-8", errors="replace").splitlines():
+        # rg --files 只输出文件，这里补上尚未出现过的上级目录
+        missing_dirs = []
+        parent = os.path.dirname(path)
+        while parent and parent not in seen_dirs:
+            seen_dirs.add(parent)
+            missing_dirs.append(parent + "/")
+            parent = os.path.dirname(parent)
+        files.extend(reversed(missing_dirs))
+        files.append(path)
+
+    return files
+
+
+def _list_files_walk(dir_path: str) -> list[str]:
+    """用 os.scandir 迭代遍历目录，直接复用 DirEntry 的类型信息，避免 os.walk 的额外开销"""
+    files = []
+    pending = deque([(dir_path, "")])
+    while pending:
+        abs_dir, rel_dir = pending.popleft()
+        try:
+            entries = os.scandir(abs_dir)
+        except OSError:
+            # 与 os.walk 一致：跳过无法访问的目录
+            continue
+
+        with entries:
+            for entry in entries:
+                rel_path = rel_dir + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name in LIST_FILES_IGNORED_DIRS:
+                        continue
+                    files.append(rel_path + "/")
+                    pending.append((entry.path, rel_path + "/"))
+                else:
+                    files.append(rel_path)
+
+    return files
+
+
+async def bash(input_data: Dict[str, Any]) -> Tuple[str, Optional[Exception]]:
     """执行 bash 命令"""
     try:
         command = input_data.get("command")
         if not command:
             return "", ValueError("command is required")
 
-        result = subprocess.run(
-            ["bash", "-c", command],
-            capture_output=True,
-            text=True,
-            timeout=30
+        # 命令可能修改文件，之前缓存的搜索/列表结果不再可信
+        clear_tool_cache()
+
+        proc = await asyncio.create_subprocess_exec(
+            "bash", "-c", command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
         )
+        async def communicate():
+            # 边读边截断，内存占用不随命令输出量增长
+            output = await asyncio.gather(
+                _bash_read_output(proc.stdout, proc),
+                _bash_read_output(proc.stderr, proc)
+            )
+            await proc.wait()
+            return output
 
-        if result.returncode != 0:
-            error_msg = f"Command failed with error: {result.stderr}\nOutput: {result.stdout}"
+        try:
+            stdout, stderr = await asyncio.wait_for(communicate(), timeout=30)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return "", TimeoutError("Command timed out after 30 seconds")
+
+        if proc.returncode != 0:
+            error_msg = f"Command failed with error: {stderr}\nOutput: {stdout}"
             return error_msg, None
 
-        return result.stdout.strip(), None
-    except subprocess.TimeoutExpired:
-        return "", TimeoutError("Command timed out after 30 seconds")
+        return stdout.strip(), None
     except Exception as e:
         return "", e
 
 
+async def _bash_read_output(stream: asyncio.StreamReader, proc: asyncio.subprocess.Process) -> str:
+    """分块读取命令输出，只保留头尾各半个 MAX_OUTPUT_BYTES；输出过多时提前终止命令"""
+    half = MAX_OUTPUT_BYTES // 2
+    head = bytearray()
+    tail = bytearray()
+    total = 0
+    while True:
+        chunk = await stream.read(64 * 1024)
+        if not chunk:
+            break
+        total += len(chunk)
+        if len(head) < half:
+            take = half - len(head)
+            head += chunk[:take]
+            chunk = chunk[take:]
+        # tail 只保留最近的 half 字节
+        tail += chunk
+        del tail[:-half]
+        if total > BASH_KILL_OUTPUT_BYTES:
+            # 输出远超上限（例如无限循环打印），不必等到超时
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            break
+    return truncate_output(bytes(head), bytes(tail), total)
+
+
 # 工具定义
 ReadFileInputSchema = {
     "type": "object",
@@ -346,24 +837,43 @@ BashDefinition = ToolDefinition(
 )
 
 
+async def run_session(client: AsyncAnthropic, session: Awaitable):
+    """运行一次会话，结束或被 Ctrl-C 取消后关闭客户端及其连接池"""
+    async with client:
+        return await session
+
+
 def main():
     parser = argparse.ArgumentParser(description="Chat with LLM - File Reading, Listing, and Bash Tools")
     parser.add_argument("--verbose", action="store_true", help="enable verbose logging")
     args = parser.parse_args()
 
-    client = Anthropic(
+    # Verbose logs go to stderr through a single handler
+    logger.addHandler(logging.StreamHandler(sys.stderr))
+    logger.setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+
+    # One pooled HTTP/2 client is shared by every API call of the session, so parallel
+    # requests are multiplexed over a single TCP/TLS connection that stays open between turns
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=120),
+        timeout=httpx.Timeout(600, connect=10)
+    )
+    client = AsyncAnthropic(
         base_url=BASE_URL,
         api_key=API_KEY,
+        http_client=http_client
     )
-    if args.verbose:
-        print("Anthropic client initialized", file=sys.stderr)
+    logger.debug("Anthropic client initialized")
 
     tools = [ReadFileDefinition, ListFilesDefinition, BashDefinition]
-    if args.verbose:
-        print(f"Initialized {len(tools)} tools", file=sys.stderr)
+    logger.debug("Initialized %s tools", len(tools))
 
     agent = Agent(client, tools, args.verbose)
-    agent.run()
+    try:
+        asyncio.run(run_session(client, agent.run()))
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == "__main__":
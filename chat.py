@@ -4,8 +4,13 @@ Basic Chat Function – Simple Conversation with LLM
 """
 
 import argparse
+import asyncio
+import logging
 import sys
-from anthropic import Anthropic
+import threading
+from typing import Awaitable
+import httpx
+from anthropic import AsyncAnthropic
 from dotenv import load_dotenv
 import os
 
@@ -13,107 +18,238 @@ load_dotenv()
 BASE_URL = os.getenv("BASE_URL")
 API_KEY = os.getenv("API_KEY")
 MODEL_NAME = os.getenv("MODEL_NAME", "glm-4.7")
+logger = logging.getLogger("agent")
+# ANSI colors are disabled when stdout is not a terminal or NO_COLOR is set
+USE_COLOR = sys.stdout.isatty() and not os.getenv("NO_COLOR")
+USER_PROMPT = "\033[94mYou\033[0m: " if USE_COLOR else "You: "
+MODEL_PROMPT = f"\033[93m{MODEL_NAME}\033[0m: " if USE_COLOR else f"{MODEL_NAME}: "
+# Number of recent turns (user + assistant exchanges) kept verbatim when older history is summarized
+HISTORY_WINDOW_TURNS = 8
+# Summarize older history once the stored conversation grows past this many messages
+HISTORY_SUMMARY_THRESHOLD = 40
+# ...or once its estimated size passes this many tokens
+HISTORY_TOKEN_BUDGET = 20000
+# Abort a streamed response if no chunk arrives within this many seconds
+STREAM_IDLE_TIMEOUT = 30
 
 class Agent:
-    def __init__(self, client: Anthropic, verbose: bool = False):
+    def __init__(self, client: AsyncAnthropic, verbose: bool = False):
         self.client = client
         self.verbose = verbose
 
-    def run(self):
+    async def run(self):
         conversation = []
 
-        if self.verbose:
-            print("Starting chat session", file=sys.stderr)
+        logger.debug("Starting chat session")
 
-        print("Chat with LLM (use 'ctrl-c' to quit)")
+        sys.stdout.write("Chat with LLM (use 'ctrl-c' to quit)\n")
 
         while True:
             try:
-                print("\033[94mYou\033[0m: ", end="", flush=True)
-                user_input = input()
+                sys.stdout.write(USER_PROMPT)
+                sys.stdout.flush()
+                user_input = await read_input()
             except (EOFError, KeyboardInterrupt):
-                if self.verbose:
-                    print("User input ended, breaking from chat loop", file=sys.stderr)
+                logger.debug("User input ended, breaking from chat loop")
                 break
 
             # Skip empty messages
             if not user_input.strip():
-                if self.verbose:
-                    print("Skipping empty message", file=sys.stderr)
+                logger.debug("Skipping empty message")
                 continue
 
-            if self.verbose:
-                print(f'User input received: "{user_input}"', file=sys.stderr)
+            logger.debug('User input received: "%s"', user_input)
+
+            # Compact only on a turn boundary, never in the middle of a tool loop
+            if len(conversation) > HISTORY_SUMMARY_THRESHOLD or estimate_tokens(conversation) > HISTORY_TOKEN_BUDGET:
+                await self.summarize_history(conversation)
 
             conversation.append({
                 "role": "user",
                 "content": user_input
             })
 
-            if self.verbose:
-                print(f"Sending message to LLM, conversation length: {len(conversation)}", file=sys.stderr)
+            logger.debug("Sending message to LLM, conversation length: %s", len(conversation))
 
-            message = self.run_inference(conversation)
-            if message is None:
+            message_text = await self.run_inference(conversation)
+            if message_text is None:
                 return
 
             conversation.append({
                 "role": "assistant",
-                "content": message["content"]
+                "content": message_text
             })
 
-            if self.verbose:
-                print(f"Received response from LLM with {len(message['content'])} content blocks", file=sys.stderr)
+            logger.debug("Received response from LLM with %s chars", len(message_text))
 
-            for content in message["content"]:
-                if content["type"] == "text":
-                    print(f"\033[93m{MODEL_NAME}\033[0m: {content['text']}")
+        logger.debug("Chat session ended")
 
-        if self.verbose:
-            print("Chat session ended", file=sys.stderr)
+    async def summarize_history(self, conversation):
+        # Replace everything before the most recent turns with a short summary exchange
+        cut = next_user_turn(conversation, max(1, len(conversation) - HISTORY_WINDOW_TURNS * 2))
+        if estimate_tokens(conversation[cut:]) > HISTORY_TOKEN_BUDGET:
+            # The recent turns alone are over budget: keep only the latest one verbatim
+            cut = previous_user_turn(conversation, len(conversation) - 1)
+        if cut >= len(conversation) or cut <= 2:
+            return
 
-    def run_inference(self, conversation):
-        if self.verbose:
-            print(f"Making API call to LLM with model: {MODEL_NAME}", file=sys.stderr)
+        logger.debug("Summarizing %s earlier messages", cut)
 
         try:
-            message = self.client.messages.create(
+            message = await self.client.messages.create(
                 model=MODEL_NAME,
                 max_tokens=1024,
-                messages=conversation
+                messages=conversation[:cut] + [{
+                    "role": "user",
+                    "content": "Summarize our conversation so far, keeping file paths, decisions and open tasks."
+                }]
             )
+        except Exception as e:
+            logger.debug("Summarization failed, keeping full history: %s", e)
+            return
+
+        summary = "".join(block.text for block in message.content if block.type == "text")
+        conversation[:cut] = [
+            {"role": "user", "content": "Summarize our conversation so far."},
+            {"role": "assistant", "content": f"Summary so far: {summary}"}
+        ]
+
+    async def run_inference(self, conversation):
+        logger.debug("Making API call to LLM with model: %s", MODEL_NAME)
+
+        try:
+            # Stream text to the terminal as it arrives instead of waiting for the full reply
+            chunks = []
+            async with self.client.messages.stream(
+                model=MODEL_NAME,
+                max_tokens=1024,
+                messages=conversation
+            ) as stream:
+                # Every event (including pings and thinking deltas) resets the idle timer;
+                # only text is written out
+                events = stream.__aiter__()
+                while True:
+                    try:
+                        event = await asyncio.wait_for(events.__anext__(), STREAM_IDLE_TIMEOUT)
+                    except StopAsyncIteration:
+                        break
+                    except asyncio.TimeoutError:
+                        raise TimeoutError(f"No response chunk received for {STREAM_IDLE_TIMEOUT} seconds")
+
+                    if event.type != "text":
+                        continue
+                    if not chunks:
+                        sys.stdout.write(MODEL_PROMPT)
+                    chunks.append(event.text)
+                    sys.stdout.write(event.text)
+                    sys.stdout.flush()
+
+            if chunks:
+                sys.stdout.write("\n")
+                sys.stdout.flush()
 
-            if self.verbose:
-                print("API call successful, response received", file=sys.stderr)
+            logger.debug("API call successful, response received")
 
-            return {
-                "content": [
-                    {"type": "text", "text": block.text}
-                    for block in message.content
-                    if block.type == "text"
-                ]
-            }
+            # Without tools the reply is plain text, which is exactly what was streamed
+            return "".join(chunks)
         except Exception as e:
-            if self.verbose:
-                print(f"API call failed: {e}", file=sys.stderr)
-            print(f"Error: {e}")
+            logger.debug("API call failed: %s", e)
+            sys.stdout.write(f"Error: {e}\n")
             return None
 
 
+def is_user_turn(message) -> bool:
+    """判断消息是否为用户发起的新一轮对话（而不是工具结果）"""
+    if message["role"] != "user":
+        return False
+    content = message["content"]
+    return isinstance(content, str) or not any(block.get("type") == "tool_result" for block in content)
+
+
+def next_user_turn(conversation, start: int) -> int:
+    """返回 start 及之后第一条用户轮次消息的下标，不存在时返回 len(conversation)"""
+    for i in range(start, len(conversation)):
+        if is_user_turn(conversation[i]):
+            return i
+    return len(conversation)
+
+
+def previous_user_turn(conversation, start: int) -> int:
+    """返回 start 及之前最后一条用户轮次消息的下标"""
+    for i in range(start, -1, -1):
+        if is_user_turn(conversation[i]):
+            return i
+    return 0
+
+
+def estimate_tokens(conversation) -> int:
+    """粗略估算对话的 token 数，按约 4 个字符一个 token 计算"""
+    return sum(len(message["content"]) for message in conversation) // 4
+
+
+async def read_input() -> str:
+    """在后台线程中读取一行用户输入，避免阻塞事件循环"""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(line, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(line)
+
+    def reader():
+        try:
+            line, error = input(), None
+        except Exception as e:
+            line, error = "", e
+        try:
+            loop.call_soon_threadsafe(resolve, line, error)
+        except RuntimeError:
+            # The event loop has already been closed (e.g. after ctrl-c)
+            pass
+
+    # A daemon thread never keeps the interpreter alive, so ctrl-c exits immediately
+    threading.Thread(target=reader, daemon=True).start()
+    return await future
+
+
+async def run_session(client: AsyncAnthropic, session: Awaitable):
+    """运行一次会话，结束或被 Ctrl-C 取消后关闭客户端及其连接池"""
+    async with client:
+        return await session
+
+
 def main():
     parser = argparse.ArgumentParser(description="Chat with LLM")
     parser.add_argument("--verbose", action="store_true", help="enable verbose logging")
     args = parser.parse_args()
 
-    client = Anthropic(
+    # Verbose logs go to stderr through a single handler
+    logger.addHandler(logging.StreamHandler(sys.stderr))
+    logger.setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+
+    # One pooled HTTP/2 client is shared by every API call of the session, so parallel
+    # requests are multiplexed over a single TCP/TLS connection that stays open between turns
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=120),
+        timeout=httpx.Timeout(600, connect=10)
+    )
+    client = AsyncAnthropic(
         api_key=API_KEY,
         base_url=BASE_URL,
+        http_client=http_client
     )
-    if args.verbose:
-        print("Anthropic client initialized", file=sys.stderr)
+    logger.debug("Anthropic client initialized")
 
     agent = Agent(client, args.verbose)
-    agent.run()
+    try:
+        asyncio.run(run_session(client, agent.run()))
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == "__main__":